@@ -5,14 +5,26 @@
 Indexa documentos no OpenSearch com embeddings do Azure OpenAI.
 """
 
+import gzip
 import json
 import os
+import time
 from datetime import datetime, timezone
 from pathlib import Path
 
 from dotenv import load_dotenv
 from openai import AzureOpenAI
 from opensearchpy import OpenSearch, helpers
+from opensearchpy.exceptions import SerializationError
+from opensearchpy.serializer import JSONSerializer
+
+from embeddings import FakeEmbeddingsClient, create_text_for_embedding
+from search_backend import SearchBackend, get_shared_memory_backend
+
+try:
+    import orjson  # Encoder JSON rápido (opcional)
+except ImportError:
+    orjson = None
 
 load_dotenv()
 
@@ -21,28 +33,68 @@ AZURE_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT")
 AZURE_API_KEY = os.getenv("AZURE_OPENAI_API_KEY")
 AZURE_DEPLOYMENT = os.getenv("AZURE_OPENAI_EMBEDDINGS_DEPLOYMENT_NAME", "text-embedding-3-small")
 AZURE_API_VERSION = os.getenv("AZURE_OPENAI_API_VERSION", "2025-01-01-preview")
+EMBEDDINGS_BACKEND = os.getenv("EMBEDDINGS_BACKEND", "azure")  # azure | fake
 
 # OpenSearch
 OPENSEARCH_HOST = os.getenv("OPENSEARCH_HOST", "localhost")
 OPENSEARCH_PORT = int(os.getenv("OPENSEARCH_PORT", 9200))
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "opensearch")  # opensearch | memory
 INDEX_NAME = "estabelecimentos_v001"
 
 BATCH_SIZE = 20
 
+# Serialização do bulk
+# - "legacy":  json da stdlib, floats completos, sem compressão, 1 bulk por batch
+# - "compact": orjson + vetores arredondados + gzip + chunks por bytes
+INGEST_MODES = ("legacy", "compact")
+INGEST_MODE = os.getenv("INGEST_MODE", "legacy")
+# Arredondamento é com perda: com componentes ~0.02 (vetor unitário de 1536 dims),
+# 6 casas decimais preservam ~4 dígitos significativos (float32 guarda ~7).
+VECTOR_DECIMALS = int(os.getenv("INGEST_VECTOR_DECIMALS", 6))  # < 0 desativa o arredondamento
+BULK_MAX_BYTES = int(os.getenv("INGEST_BULK_MAX_BYTES", 5 * 1024 * 1024))
+BULK_MAX_DOCS = 10_000  # Teto de segurança; o limite efetivo é BULK_MAX_BYTES
+
+
+class FastJSONSerializer(JSONSerializer):
+    """JSONSerializer do opensearch-py usando orjson quando disponível."""
+
+    def dumps(self, data):
+        if orjson is None or isinstance(data, str):
+            return super().dumps(data)
+        try:
+            return orjson.dumps(data, default=self.default).decode("utf-8")
+        except (TypeError, orjson.JSONEncodeError) as e:
+            raise SerializationError(data, e)
+
+    def loads(self, s):
+        if orjson is None:
+            return super().loads(s)
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError as e:
+            raise SerializationError(s, e)
+
 
-def get_azure_client() -> AzureOpenAI:
+def get_azure_client() -> AzureOpenAI | FakeEmbeddingsClient:
+    if EMBEDDINGS_BACKEND == "fake":
+        return FakeEmbeddingsClient()
     if not AZURE_API_KEY or not AZURE_ENDPOINT:
         raise ValueError("Configure AZURE_OPENAI_API_KEY e AZURE_OPENAI_ENDPOINT no .env")
     return AzureOpenAI(api_key=AZURE_API_KEY, api_version=AZURE_API_VERSION, azure_endpoint=AZURE_ENDPOINT)
 
 
-def get_opensearch_client() -> OpenSearch:
-    return OpenSearch(hosts=[{"host": OPENSEARCH_HOST, "port": OPENSEARCH_PORT}], use_ssl=False, verify_certs=False, timeout=60)
+def is_compact_mode() -> bool:
+    if INGEST_MODE not in INGEST_MODES:
+        raise ValueError(f"INGEST_MODE inválido: '{INGEST_MODE}' (use {' ou '.join(INGEST_MODES)})")
+    return INGEST_MODE == "compact"
 
 
-def create_text_for_embedding(doc: dict) -> str:
-    parts = [doc.get("razao_social", ""), doc.get("nome_fantasia", ""), doc.get("cnae_descricao", ""), doc.get("descricao_atividade", ""), doc.get("endereco", {}).get("cidade", ""), doc.get("endereco", {}).get("uf", "")]
-    return " | ".join(filter(None, parts))
+def get_opensearch_client() -> OpenSearch | SearchBackend:
+    if SEARCH_BACKEND == "memory":
+        return get_shared_memory_backend()
+    # http_compress: corpo das requisições enviado com Content-Encoding: gzip
+    kwargs = {"http_compress": True, "serializer": FastJSONSerializer()} if is_compact_mode() else {}
+    return OpenSearch(hosts=[{"host": OPENSEARCH_HOST, "port": OPENSEARCH_PORT}], use_ssl=False, verify_certs=False, timeout=60, **kwargs)
 
 
 def generate_embeddings_batch(client: AzureOpenAI, texts: list[str]) -> list[list[float]]:
@@ -50,19 +102,51 @@ def generate_embeddings_batch(client: AzureOpenAI, texts: list[str]) -> list[lis
     return [item.embedding for item in response.data]
 
 
-def index_documents(documents: list[dict]) -> tuple[int, int]:
-    azure_client = get_azure_client()
-    os_client = get_opensearch_client()
-    
-    print(f"📡 Azure OpenAI: {AZURE_ENDPOINT}")
-    print(f"   Deployment: {AZURE_DEPLOYMENT}")
-    
-    info = os_client.info()
-    print(f"📡 OpenSearch: {info['version']['number']}")
+def round_vector(vector: list[float], decimals: int = VECTOR_DECIMALS) -> list[float]:
+    """Arredonda o vetor para encurtar o JSON (com perda; ver VECTOR_DECIMALS)."""
+    if decimals < 0:
+        return vector
+    return [round(x, decimals) for x in vector]
+
+
+def encode_bulk_body(actions: list[dict], serializer: JSONSerializer) -> bytes:
+    """Serializa as actions no formato NDJSON do _bulk."""
+    lines = []
+    for action in actions:
+        lines.append(serializer.dumps({"index": {"_index": action["_index"], "_id": action["_id"]}}))
+        lines.append(serializer.dumps(action["_source"]))
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def measure_payload(actions: list[dict], serializer: JSONSerializer, compress: bool = False) -> tuple[float, float]:
+    """Retorna (bytes/doc, ms de encode) para o corpo do bulk."""
+    start = time.perf_counter()
+    body = encode_bulk_body(actions, serializer)
+    encode_ms = (time.perf_counter() - start) * 1000
+    if compress:
+        body = gzip.compress(body)
+    return len(body) / len(actions), encode_ms
+
+
+def report_payload(actions: list[dict]):
+    """Compara o payload do modo legacy com o modo compact para um batch."""
+    start = time.perf_counter()
+    compact_actions = [{**a, "_source": {**a["_source"], "embedding": round_vector(a["_source"]["embedding"])}} for a in actions]
+    round_ms = (time.perf_counter() - start) * 1000
     
-    now = datetime.now(timezone.utc).isoformat()
-    total_success, total_failed = 0, 0
+    legacy_bytes, legacy_ms = measure_payload(actions, JSONSerializer())
+    compact_bytes, compact_ms = measure_payload(compact_actions, FastJSONSerializer())
+    compact_ms += round_ms
+    gzip_bytes, _ = measure_payload(compact_actions, FastJSONSerializer(), compress=True)
     
+    print(f"   📏 Payload legacy:  {legacy_bytes / 1024:.1f} KB/doc, encode {legacy_ms:.1f} ms")
+    print(f"   📏 Payload compact: {compact_bytes / 1024:.1f} KB/doc, encode {compact_ms:.1f} ms (gzip: {gzip_bytes / 1024:.1f} KB/doc)")
+    if orjson is None:
+        print("   ⚠️  orjson não instalado, usando json da stdlib")
+
+
+def generate_action_batches(documents: list[dict], azure_client: AzureOpenAI, now: str):
+    """Gera as actions do bulk por batch de BATCH_SIZE (uma chamada de embedding por batch)."""
     for i in range(0, len(documents), BATCH_SIZE):
         batch = documents[i:i + BATCH_SIZE]
         batch_num = i // BATCH_SIZE + 1
@@ -83,14 +167,78 @@ def index_documents(documents: list[dict]) -> tuple[int, int]:
             doc["indexed_at"] = now
             actions.append({"_index": INDEX_NAME, "_id": doc_id, "_source": doc})
         
+        if i == 0:
+            report_payload(actions)
+        
+        if is_compact_mode():
+            for action in actions:
+                action["_source"]["embedding"] = round_vector(action["_source"]["embedding"])
+        
+        yield actions
+
+
+def index_batches(os_client: OpenSearch | SearchBackend, batches) -> tuple[int, int]:
+    """legacy: um helpers.bulk por batch de embeddings, como antes."""
+    total_success, total_failed = 0, 0
+    for actions in batches:
         print("   📥 Indexando...")
         success, failed = helpers.bulk(os_client, actions, stats_only=True, raise_on_error=False)
         total_success += success
         total_failed += failed
         print(f"   ✅ {success} indexados, ❌ {failed} falhas")
+    return total_success, total_failed
+
+
+def index_streaming(os_client: OpenSearch | SearchBackend, batches) -> tuple[int, int]:
+    """
+    compact: um único stream para o helper, que fecha cada chunk ao atingir
+    BULK_MAX_BYTES (tamanho antes do gzip).
+    
+    O helper só envia um chunk quando chega a action seguinte; se um embedding
+    falhar, o stream é encerrado para que o chunk já acumulado seja enviado e
+    só então o erro é propagado.
+    """
+    failure = None
+    
+    def stream():
+        nonlocal failure
+        try:
+            for actions in batches:
+                yield from actions
+        except Exception as e:
+            failure = e
+    
+    success, failed = helpers.bulk(os_client, stream(), stats_only=True, raise_on_error=False, chunk_size=BULK_MAX_DOCS, max_chunk_bytes=BULK_MAX_BYTES)
+    print(f"\n   ✅ {success} indexados, ❌ {failed} falhas")
+    if failure is not None:
+        raise failure
+    return success, failed
+
+
+def index_documents(documents: list[dict]) -> tuple[int, int]:
+    azure_client = get_azure_client()
+    os_client = get_opensearch_client()
+    
+    if EMBEDDINGS_BACKEND == "fake":
+        print("📡 Embeddings: fake (offline, determinístico)")
+    else:
+        print(f"📡 Azure OpenAI: {AZURE_ENDPOINT}")
+        print(f"   Deployment: {AZURE_DEPLOYMENT}")
+    
+    info = os_client.info()
+    print(f"📡 OpenSearch: {info['version']['number']}")
+    print(f"   Modo de ingestão: {INGEST_MODE}")
+    
+    now = datetime.now(timezone.utc).isoformat()
+    batches = generate_action_batches(documents, azure_client, now)
+    
+    if is_compact_mode():
+        success, failed = index_streaming(os_client, batches)
+    else:
+        success, failed = index_batches(os_client, batches)
     
     os_client.indices.refresh(index=INDEX_NAME)
-    return total_success, total_failed
+    return success, failed
 
 
 if __name__ == "__main__":
@@ -110,6 +258,10 @@ if __name__ == "__main__":
         documents = json.load(f)
     print(f"   {len(documents)} documentos")
     
+    if SEARCH_BACKEND == "memory":
+        print("\n⚠️  Backend em memória: o índice existe só neste processo")
+        print("   (04_hybrid_queries.py recarrega o dataset por conta própria)")
+    
     try:
         success, failed = index_documents(documents)
         
@@ -5,10 +5,24 @@
 Demonstra queries híbridas: Full-text + k-NN + Geo.
 """
 
+import json
 import os
+import queue
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from pathlib import Path
+from typing import Iterator
+
 from dotenv import load_dotenv
 from openai import AzureOpenAI
-from opensearchpy import OpenSearch
+from opensearchpy import OpenSearch, helpers
+
+from embeddings import FakeEmbeddingsClient, create_text_for_embedding
+from search_backend import get_shared_memory_backend
 
 load_dotenv()
 
@@ -17,27 +31,134 @@ AZURE_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT")
 AZURE_API_KEY = os.getenv("AZURE_OPENAI_API_KEY")
 AZURE_DEPLOYMENT = os.getenv("AZURE_OPENAI_EMBEDDINGS_DEPLOYMENT_NAME", "text-embedding-3-small")
 AZURE_API_VERSION = os.getenv("AZURE_OPENAI_API_VERSION", "2025-01-01-preview")
+EMBEDDINGS_BACKEND = os.getenv("EMBEDDINGS_BACKEND", "azure")  # azure | fake
 
 # OpenSearch
 OPENSEARCH_HOST = os.getenv("OPENSEARCH_HOST", "localhost")
 OPENSEARCH_PORT = int(os.getenv("OPENSEARCH_PORT", 9200))
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "opensearch")  # opensearch | memory
 INDEX_NAME = "estabelecimentos_v001"
+DATA_FILE = Path(__file__).parent.parent / "data" / "estabelecimentos_demo.json"
+
+# Exportação (PIT + search_after)
+EXPORT_PAGE_SIZE = 1000
+EXPORT_KEEP_ALIVE = "2m"
+TIEBREAKER_FIELD = "cnpj"  # keyword único por estabelecimento
+
+# Orçamento de latência (query_hybrid com latency_budget_ms)
+HEDGE_DEFAULT_DELAY_MS = 50   # Atraso do hedge até haver amostras suficientes
+HEDGE_MIN_SAMPLES = 20        # Amostras mínimas para usar o p95 observado
+SEARCH_MAX_WAIT_MS = 2000     # Teto da busca hedgeada (primária + hedge)
+LATENCY_WINDOW = 200          # Latências recentes consideradas no p95
+BREAKER_FAILURE_THRESHOLD = 3 # Falhas consecutivas até abrir o circuito
+BREAKER_RESET_SECONDS = 30    # Tempo com o circuito aberto antes de testar de novo
+EMBEDDING_MAX_CONCURRENCY = 16 # Embeddings simultâneos; acima disso a query degrada na hora
+
+TEXT_FIELDS = ["razao_social^2", "nome_fantasia^2", "cnae_descricao^3", "descricao_atividade"]
 
 azure_client = None
 os_client = None
 
 
+class CircuitBreaker:
+    """Circuit breaker simples: closed -> open após N falhas -> half-open após o cooldown."""
+
+    def __init__(self, failure_threshold: int = BREAKER_FAILURE_THRESHOLD, reset_seconds: float = BREAKER_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            # half-open: deixa uma chamada passar e reabre se falhar de novo
+            if time.monotonic() - self.opened_at >= self.reset_seconds:
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+class LatencyTracker:
+    """Janela deslizante de latências (ms) para calcular o p95."""
+
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self.samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, latency_ms: float):
+        with self._lock:
+            self.samples.append(latency_ms)
+
+    def p95(self) -> float | None:
+        with self._lock:
+            if len(self.samples) < HEDGE_MIN_SAMPLES:
+                return None
+            ordered = sorted(self.samples)
+        return ordered[int(len(ordered) * 0.95) - 1]
+
+
+embedding_breaker = CircuitBreaker()
+search_latency = LatencyTracker()
+# Pools separados: embeddings lentos não podem ocupar os workers das buscas
+_embedding_executor = ThreadPoolExecutor(max_workers=EMBEDDING_MAX_CONCURRENCY)
+# Uma vaga por worker: chamadas nunca esperam na fila do pool consumindo o orçamento
+_embedding_slots = threading.BoundedSemaphore(EMBEDDING_MAX_CONCURRENCY)
+_search_executor = ThreadPoolExecutor(max_workers=8)
+
+
 def init_clients():
     global azure_client, os_client
-    if AZURE_API_KEY and AZURE_ENDPOINT:
+    if EMBEDDINGS_BACKEND == "fake":
+        azure_client = FakeEmbeddingsClient()
+    elif AZURE_API_KEY and AZURE_ENDPOINT:
         azure_client = AzureOpenAI(api_key=AZURE_API_KEY, api_version=AZURE_API_VERSION, azure_endpoint=AZURE_ENDPOINT)
-    os_client = OpenSearch(hosts=[{"host": OPENSEARCH_HOST, "port": OPENSEARCH_PORT}], use_ssl=False, verify_certs=False, timeout=30)
+    if SEARCH_BACKEND == "memory":
+        os_client = get_shared_memory_backend()
+        load_memory_index()
+    else:
+        os_client = OpenSearch(hosts=[{"host": OPENSEARCH_HOST, "port": OPENSEARCH_PORT}], use_ssl=False, verify_certs=False, timeout=30)
 
 
-def get_embedding(text: str) -> list[float]:
-    if not azure_client:
+def load_memory_index():
+    """
+    Backend em memória: carrega o dataset demo se o índice ainda não existir.
+    Com cliente de embeddings configurado (Azure ou fake), os vetores são gerados na carga.
+    """
+    if os_client.indices.exists(index=INDEX_NAME):
+        return
+    os_client.indices.create(index=INDEX_NAME)
+    if not DATA_FILE.exists():
+        return
+    with open(DATA_FILE, "r", encoding="utf-8") as f:
+        documents = json.load(f)
+    if azure_client:
+        texts = [create_text_for_embedding(doc) for doc in documents]
+        response = azure_client.embeddings.create(input=texts, model=AZURE_DEPLOYMENT)
+        for doc, item in zip(documents, response.data):
+            doc["embedding"] = item.embedding
+    actions = ({"_index": INDEX_NAME, "_id": doc.pop("_id", None), "_source": doc} for doc in documents)
+    helpers.bulk(os_client, actions)
+
+
+def get_embedding(text: str, client: AzureOpenAI | None = None) -> list[float]:
+    client = client or azure_client
+    if not client:
         raise ValueError("Azure OpenAI não configurado")
-    response = azure_client.embeddings.create(input=[text], model=AZURE_DEPLOYMENT)
+    response = client.embeddings.create(input=[text], model=AZURE_DEPLOYMENT)
     return response.data[0].embedding
 
 
@@ -60,13 +181,63 @@ def print_results(results: dict, title: str):
             print(f"   Score: {score:.4f}")
 
 
-def query_fulltext(query: str, size: int = 5):
-    """Query 1: Full-Text (BM25)"""
-    body = {
+# =============================================================================
+# Builders de query
+# =============================================================================
+
+def build_text_clause(query: str) -> dict:
+    return {"multi_match": {"query": query, "fields": TEXT_FIELDS, "type": "best_fields", "fuzziness": "AUTO"}}
+
+
+def build_fulltext_body(query: str, size: int = 5, filters: list[dict] | None = None) -> dict:
+    text_clause = build_text_clause(query)
+    return {
+        "size": size,
+        "query": {"bool": {"must": [text_clause], "filter": filters}} if filters else text_clause,
+        "_source": {"excludes": ["embedding"]}
+    }
+
+
+def build_knn_body(query_vector: list[float], k: int = 5) -> dict:
+    return {
+        "size": k,
+        "query": {"knn": {"embedding": {"vector": query_vector, "k": k}}},
+        "_source": {"excludes": ["embedding"]}
+    }
+
+
+def build_geo_body(lat: float, lon: float, distance: str = "50km", size: int = 5) -> dict:
+    return {
+        "size": size,
+        "query": {"bool": {"filter": {"geo_distance": {"distance": distance, "localizacao": {"lat": lat, "lon": lon}}}}},
+        "sort": [{"_geo_distance": {"localizacao": {"lat": lat, "lon": lon}, "order": "asc", "unit": "km"}}],
+        "_source": {"excludes": ["embedding"]}
+    }
+
+
+def build_hybrid_body(text_query: str, lat: float, lon: float, distance: str = "100km", size: int = 5, query_vector: list[float] | None = None, filters: list[dict] | None = None) -> dict:
+    must = [build_text_clause(text_query)]
+    should = []
+    filter_clauses = [{"geo_distance": {"distance": distance, "localizacao": {"lat": lat, "lon": lon}}}] + (filters or [])
+    
+    if query_vector is not None:
+        should.append({"knn": {"embedding": {"vector": query_vector, "k": size * 2}}})
+    
+    return {
         "size": size,
-        "query": {"multi_match": {"query": query, "fields": ["razao_social^2", "nome_fantasia^2", "cnae_descricao^3", "descricao_atividade"], "type": "best_fields", "fuzziness": "AUTO"}},
+        "query": {"bool": {"must": must, "should": should, "filter": filter_clauses}},
+        "sort": ["_score", {"_geo_distance": {"localizacao": {"lat": lat, "lon": lon}, "order": "asc", "unit": "km"}}],
         "_source": {"excludes": ["embedding"]}
     }
+
+
+# =============================================================================
+# Queries
+# =============================================================================
+
+def query_fulltext(query: str, size: int = 5):
+    """Query 1: Full-Text (BM25)"""
+    body = build_fulltext_body(query, size)
     results = os_client.search(index=INDEX_NAME, body=body)
     print_results(results, f"FULL-TEXT: '{query}'")
     return results
@@ -78,12 +249,7 @@ def query_knn(query: str, k: int = 5):
         print("\n⚠️  k-NN requer Azure OpenAI configurado")
         return None
     
-    query_vector = get_embedding(query)
-    body = {
-        "size": k,
-        "query": {"knn": {"embedding": {"vector": query_vector, "k": k}}},
-        "_source": {"excludes": ["embedding"]}
-    }
+    body = build_knn_body(get_embedding(query), k)
     results = os_client.search(index=INDEX_NAME, body=body)
     print_results(results, f"k-NN SEMÂNTICA: '{query}'")
     return results
@@ -91,12 +257,7 @@ def query_knn(query: str, k: int = 5):
 
 def query_geo(lat: float, lon: float, distance: str = "50km", size: int = 5):
     """Query 3: Geoespacial"""
-    body = {
-        "size": size,
-        "query": {"bool": {"filter": {"geo_distance": {"distance": distance, "localizacao": {"lat": lat, "lon": lon}}}}},
-        "sort": [{"_geo_distance": {"localizacao": {"lat": lat, "lon": lon}, "order": "asc", "unit": "km"}}],
-        "_source": {"excludes": ["embedding"]}
-    }
+    body = build_geo_body(lat, lon, distance, size)
     results = os_client.search(index=INDEX_NAME, body=body)
     
     for hit in results["hits"]["hits"]:
@@ -111,34 +272,229 @@ def query_geo(lat: float, lon: float, distance: str = "50km", size: int = 5):
     return results
 
 
-def query_hybrid(text_query: str, lat: float, lon: float, distance: str = "100km", size: int = 5, use_knn: bool = True):
-    """Query 4: HÍBRIDA (Full-text + k-NN + Geo)"""
-    must = [{"multi_match": {"query": text_query, "fields": ["razao_social^2", "nome_fantasia^2", "cnae_descricao^3", "descricao_atividade"], "type": "best_fields", "fuzziness": "AUTO"}}]
-    should = []
-    filter_clauses = [{"geo_distance": {"distance": distance, "localizacao": {"lat": lat, "lon": lon}}}]
+def get_embedding_within_budget(text: str, budget_ms: float) -> tuple[list[float] | None, str | None]:
+    """
+    Gera o embedding respeitando o orçamento de latência.
     
-    if use_knn and azure_client:
-        query_vector = get_embedding(text_query)
-        should.append({"knn": {"embedding": {"vector": query_vector, "k": size * 2}}})
+    Só falhas do endpoint (erro ou timeout de uma chamada em andamento)
+    alimentam o circuit breaker; falta de vaga local não.
     
-    body = {
-        "size": size,
-        "query": {"bool": {"must": must, "should": should, "filter": filter_clauses}},
-        "sort": ["_score", {"_geo_distance": {"localizacao": {"lat": lat, "lon": lon}, "order": "asc", "unit": "km"}}],
-        "_source": {"excludes": ["embedding"]}
-    }
+    Returns:
+        (vetor, None) em caso de sucesso, ou (None, motivo) se não houver
+        vaga (embedding_saturated), o circuito estiver aberto, a chamada
+        falhar ou estourar o orçamento.
+    """
+    if not _embedding_slots.acquire(blocking=False):
+        return None, "embedding_saturated"
     
-    results = os_client.search(index=INDEX_NAME, body=body)
+    if not embedding_breaker.allow():
+        _embedding_slots.release()
+        return None, "circuit_open"
+    
+    def call_embedding():
+        try:
+            return get_embedding(text, budget_client)
+        finally:
+            _embedding_slots.release()
+    
+    # Timeout do próprio cliente = orçamento, sem retries: a thread é liberada logo após o corte
+    budget_client = azure_client.with_options(timeout=budget_ms / 1000, max_retries=0)
+    future = _embedding_executor.submit(call_embedding)
+    try:
+        vector = future.result(timeout=budget_ms / 1000)
+    except FutureTimeoutError:
+        if future.cancel():
+            # Nem chegou a rodar: não é falha do endpoint
+            _embedding_slots.release()
+            return None, "embedding_saturated"
+        # O resultado tardio é descartado (a chamada expira pelo timeout do cliente)
+        embedding_breaker.record_failure()
+        return None, "embedding_timeout"
+    except Exception:
+        embedding_breaker.record_failure()
+        return None, "embedding_error"
+    
+    embedding_breaker.record_success()
+    return vector, None
+
+
+def _timed_search(body: dict, preference: str | None = None, timeout_s: float | None = None) -> dict:
+    start = time.perf_counter()
+    params = {"preference": preference} if preference else {}
+    if timeout_s is not None:
+        params["request_timeout"] = timeout_s
+    results = os_client.search(index=INDEX_NAME, body=body, params=params)
+    search_latency.record((time.perf_counter() - start) * 1000)
+    return results
+
+
+def search_hedged(body: dict) -> tuple[dict, bool]:
+    """
+    Executa a busca e, se não responder até o p95 observado, dispara uma
+    segunda cópia com outra `preference` (tende a cair em outra réplica).
+    Retorna a primeira resposta bem-sucedida e se o hedge foi disparado.
+    Levanta TimeoutError se nada responder em SEARCH_MAX_WAIT_MS.
+    """
+    max_wait_s = SEARCH_MAX_WAIT_MS / 1000
+    deadline = time.monotonic() + max_wait_s
+    delay_ms = min(search_latency.p95() or HEDGE_DEFAULT_DELAY_MS, SEARCH_MAX_WAIT_MS)
+    primary = _search_executor.submit(_timed_search, body, None, max_wait_s)
+    done, _ = wait([primary], timeout=delay_ms / 1000)
+    if done:
+        return primary.result(), False
+    
+    remaining_s = max(deadline - time.monotonic(), 0)
+    hedge = _search_executor.submit(_timed_search, body, f"hedge-{uuid.uuid4().hex}", remaining_s)
+    pending = {primary, hedge}
+    error = TimeoutError(f"Busca sem resposta em {SEARCH_MAX_WAIT_MS} ms")
+    while pending:
+        done, pending = wait(pending, timeout=max(deadline - time.monotonic(), 0), return_when=FIRST_COMPLETED)
+        if not done:
+            raise TimeoutError(f"Busca sem resposta em {SEARCH_MAX_WAIT_MS} ms")
+        for future in done:
+            if future.exception() is None:
+                return future.result(), True
+            error = future.exception()
+    raise error
+
+
+def query_hybrid(text_query: str, lat: float, lon: float, distance: str = "100km", size: int = 5, use_knn: bool = True, latency_budget_ms: float | None = None):
+    """
+    Query 4: HÍBRIDA (Full-text + k-NN + Geo)
+    
+    Com latency_budget_ms, o embedding tem até esse tempo para responder
+    (senão roda só BM25+Geo e a resposta sai com "degraded": True), a busca
+    é hedgeada após o p95 e um circuit breaker evita chamar o Azure OpenAI
+    durante indisponibilidades.
+    """
+    degraded_reason = None
+    query_vector = None
+    if use_knn and azure_client:
+        if latency_budget_ms is None:
+            query_vector = get_embedding(text_query)
+        else:
+            query_vector, degraded_reason = get_embedding_within_budget(text_query, latency_budget_ms)
+    body = build_hybrid_body(text_query, lat, lon, distance, size, query_vector)
+    
+    if latency_budget_ms is None:
+        results = os_client.search(index=INDEX_NAME, body=body)
+    else:
+        results, hedged = search_hedged(body)
+        results["degraded"] = degraded_reason is not None
+        results["degraded_reason"] = degraded_reason
+        results["hedged"] = hedged
     
     for hit in results["hits"]["hits"]:
         if "sort" in hit and len(hit["sort"]) > 1:
             hit["_source"]["_distancia_km"] = round(hit["sort"][1], 2)
     
-    knn_label = "+ k-NN" if use_knn and azure_client else "(sem k-NN)"
+    knn_label = "+ k-NN" if query_vector is not None else "(sem k-NN)"
+    if degraded_reason:
+        knn_label += f" [degradada: {degraded_reason}]"
     print_results(results, f"HÍBRIDA {knn_label}: '{text_query}' em {distance} de ({lat}, {lon})")
     return results
 
 
+# =============================================================================
+# Exportação (PIT + search_after)
+# =============================================================================
+
+def build_export_body(body: dict, page_size: int, source_includes: list[str] | None = None) -> dict:
+    """Adapta o body de um builder para paginação profunda: sem from/size fixos, sort com desempate."""
+    export_body = {k: v for k, v in body.items() if k not in ("size", "from")}
+    sort = [c for c in body.get("sort", []) if c != TIEBREAKER_FIELD]
+    export_body["sort"] = sort + [{TIEBREAKER_FIELD: "asc"}]
+    export_body["size"] = page_size
+    export_body["track_total_hits"] = False
+    if source_includes is not None:
+        export_body["_source"] = {"includes": source_includes, "excludes": ["embedding"]}
+    return export_body
+
+
+def _iter_pit_pages(body: dict, pit_id: str, keep_alive: str, slice_spec: dict | None = None) -> Iterator[dict]:
+    search_after = None
+    while True:
+        page_body = {**body, "pit": {"id": pit_id, "keep_alive": keep_alive}}
+        if slice_spec:
+            page_body["slice"] = slice_spec
+        if search_after is not None:
+            page_body["search_after"] = search_after
+        
+        hits = os_client.search(body=page_body)["hits"]["hits"]
+        yield from hits
+        
+        if len(hits) < body["size"]:
+            return
+        search_after = hits[-1]["sort"]
+
+
+def _iter_slices_parallel(body: dict, pit_id: str, keep_alive: str, slices: int) -> Iterator[dict]:
+    """Consome N slices em threads; os hits chegam por uma fila limitada (backpressure)."""
+    hits_queue = queue.Queue(maxsize=body["size"] * slices)
+    done = object()
+    stop = threading.Event()
+    
+    def worker(slice_id: int):
+        try:
+            for hit in _iter_pit_pages(body, pit_id, keep_alive, {"id": slice_id, "max": slices}):
+                if stop.is_set():
+                    return
+                hits_queue.put(hit)
+        except Exception as e:
+            hits_queue.put(e)
+        finally:
+            hits_queue.put(done)
+    
+    with ThreadPoolExecutor(max_workers=slices) as executor:
+        for slice_id in range(slices):
+            executor.submit(worker, slice_id)
+        
+        finished = 0
+        try:
+            while finished < slices:
+                item = hits_queue.get()
+                if item is done:
+                    finished += 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+        finally:
+            # Libera workers bloqueados em put() se o consumidor parar antes do fim
+            stop.set()
+            while finished < slices:
+                if hits_queue.get() is done:
+                    finished += 1
+
+
+def export_results(body: dict, source_includes: list[str] | None = None, page_size: int = EXPORT_PAGE_SIZE, slices: int = 1, keep_alive: str = EXPORT_KEEP_ALIVE) -> Iterator[dict]:
+    """
+    Exporta todos os hits de uma query (sem o limite de from/size).
+    
+    Abre um point-in-time, pagina com search_after sobre o sort da query
+    + desempate por TIEBREAKER_FIELD e fecha o PIT ao final.
+    
+    Args:
+        body: Body gerado por um dos build_*_body
+        source_includes: Campos do _source a retornar (None = todos, exceto embedding)
+        page_size: Hits por página
+        slices: Se > 1, usa sliced search em paralelo (ordem global não é preservada)
+        keep_alive: Tempo de vida do PIT entre páginas
+        
+    Yields:
+        Hits no formato da resposta do OpenSearch
+    """
+    export_body = build_export_body(body, page_size, source_includes)
+    pit_id = os_client.create_pit(index=INDEX_NAME, keep_alive=keep_alive)["pit_id"]
+    try:
+        if slices > 1:
+            yield from _iter_slices_parallel(export_body, pit_id, keep_alive, slices)
+        else:
+            yield from _iter_pit_pages(export_body, pit_id, keep_alive)
+    finally:
+        os_client.delete_pit(body={"pit_id": [pit_id]})
+
+
 def run_demo():
     print("\n" + "=" * 60)
     print("🚀 DEMONSTRAÇÃO DE QUERIES HÍBRIDAS")
@@ -175,6 +531,18 @@ def run_demo():
     
     query_hybrid(text_query="areia cascalho construção", lat=SP_LAT, lon=SP_LON, distance="50km", size=3)
     
+    query_hybrid(text_query="areia cascalho construção", lat=SP_LAT, lon=SP_LON, distance="50km", size=3, latency_budget_ms=300)
+    
+    print("\n" + "-" * 60)
+    print("📤 EXPORTAÇÃO (PIT + search_after)")
+    print("-" * 60)
+    filters = [{"term": {"situacao_cadastral": "ATIVA"}}, {"term": {"endereco.uf": "SP"}}]
+    body = build_fulltext_body("materiais de construção", filters=filters)
+    exported = 0
+    for hit in export_results(body, source_includes=["cnpj", "razao_social", "endereco.cidade"], slices=2):
+        exported += 1
+    print(f"\n✅ {exported} estabelecimentos ativos em SP exportados para 'materiais de construção'")
+    
     print("\n" + "=" * 60)
     print("✅ Demonstração concluída!")
     print("=" * 60)
@@ -186,9 +554,14 @@ if __name__ == "__main__":
     print("=" * 60)
     print("🔍 QUERIES HÍBRIDAS - OpenSearch")
     print("=" * 60)
-    print(f"\n📡 OpenSearch: {OPENSEARCH_HOST}:{OPENSEARCH_PORT}")
+    if SEARCH_BACKEND == "memory":
+        print("\n📡 Backend: em memória (search_backend.InMemoryBackend)")
+    else:
+        print(f"\n📡 OpenSearch: {OPENSEARCH_HOST}:{OPENSEARCH_PORT}")
     
-    if azure_client:
+    if EMBEDDINGS_BACKEND == "fake":
+        print("📡 Embeddings: fake (offline, determinístico)")
+    elif azure_client:
         print(f"📡 Azure OpenAI: {AZURE_ENDPOINT}")
         print(f"   Deployment: {AZURE_DEPLOYMENT}")
     else:
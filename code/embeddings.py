@@ -0,0 +1,53 @@
+"""
+embeddings.py
+=============
+
+Texto para embedding e embedder offline determinístico.
+
+Com EMBEDDINGS_BACKEND=fake, 03 e 04 usam o `FakeEmbeddingsClient` no lugar
+do Azure OpenAI: cada token (mesma análise do backend em memória) soma ±1 em
+algumas dimensões escolhidas por hash e o vetor é normalizado. Textos com
+tokens em comum ficam próximos no cosseno, o que basta para exercitar k-NN e
+fusão híbrida sem serviços externos. Não tem qualidade semântica.
+"""
+
+import hashlib
+import math
+from types import SimpleNamespace
+
+from search_backend import analyze
+
+EMBEDDING_DIM = 1536  # text-embedding-3-small
+FAKE_DIMS_PER_TOKEN = 8
+
+
+def create_text_for_embedding(doc: dict) -> str:
+    parts = [doc.get("razao_social", ""), doc.get("nome_fantasia", ""), doc.get("cnae_descricao", ""), doc.get("descricao_atividade", ""), doc.get("endereco", {}).get("cidade", ""), doc.get("endereco", {}).get("uf", "")]
+    return " | ".join(filter(None, parts))
+
+
+def fake_embedding(text: str, dim: int = EMBEDDING_DIM) -> list[float]:
+    """Vetor unitário por hashing de tokens (mesmo texto -> mesmo vetor)."""
+    vector = [0.0] * dim
+    for token in analyze(text):
+        for i in range(FAKE_DIMS_PER_TOKEN):
+            digest = int.from_bytes(hashlib.blake2b(f"{token}:{i}".encode("utf-8"), digest_size=8).digest(), "big")
+            vector[digest % dim] += 1.0 if (digest >> 63) else -1.0
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return [x / norm for x in vector]
+
+
+class FakeEmbeddingsClient:
+    """Imita o subconjunto do AzureOpenAI usado pelos scripts (`embeddings.create`, `with_options`)."""
+
+    def __init__(self, dim: int = EMBEDDING_DIM):
+        self.dim = dim
+        self.embeddings = SimpleNamespace(create=self._create)
+
+    def _create(self, input: str | list[str], model: str | None = None) -> SimpleNamespace:
+        texts = [input] if isinstance(input, str) else input
+        data = [SimpleNamespace(index=i, embedding=fake_embedding(text, self.dim)) for i, text in enumerate(texts)]
+        return SimpleNamespace(data=data, model=model or "fake")
+
+    def with_options(self, **kwargs) -> "FakeEmbeddingsClient":
+        return self
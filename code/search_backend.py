@@ -0,0 +1,669 @@
+"""
+search_backend.py
+=================
+
+Interface de backend de busca e implementação em memória.
+
+O `InMemoryBackend` cobre o subconjunto da API do cliente OpenSearch usado
+pelos scripts (search, msearch, bulk, count + indices/PIT), permitindo rodar
+ingestão, queries e benchmarks sem serviços externos:
+
+- BM25 sobre índice invertido dos campos de texto analisados
+- k-NN por força bruta sobre uma matriz NumPy (cosinesimil)
+- Filtro e sort `geo_distance` com haversine vetorizado
+
+Aproximações em relação ao OpenSearch: o analyzer não aplica stemming,
+`fuzziness` usa distância de Levenshtein sobre o vocabulário do campo e o
+índice é atualizado a cada bulk (sem esperar refresh).
+"""
+
+import json
+import math
+import re
+import threading
+import time
+import unicodedata
+import uuid
+import zlib
+from types import SimpleNamespace
+from typing import Any, Protocol
+
+import numpy as np
+from opensearchpy.serializer import JSONSerializer
+
+# BM25 (mesmos defaults do Lucene)
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+EARTH_RADIUS_KM = 6371.0088
+DISTANCE_UNITS_KM = {"km": 1.0, "m": 0.001, "mi": 1.609344, "yd": 0.0009144, "ft": 0.0003048}
+
+# Stopwords do analyzer brazilian_text (subconjunto de _brazilian_)
+STOPWORDS = {
+    "a", "ao", "aos", "as", "com", "como", "da", "das", "de", "do", "dos", "e", "em", "entre",
+    "na", "nas", "no", "nos", "o", "os", "ou", "para", "pela", "pelas", "pelo", "pelos", "por",
+    "que", "se", "sem", "sob", "sobre", "um", "uma", "umas", "uns",
+}
+
+
+class SearchIndices(Protocol):
+    """Subconjunto de `client.indices` usado pelos scripts."""
+
+    def exists(self, index: str, params: dict | None = None) -> bool: ...
+
+    def create(self, index: str, body: dict | None = None, params: dict | None = None) -> dict: ...
+
+    def refresh(self, index: str | None = None, params: dict | None = None) -> dict: ...
+
+
+class SearchBackend(Protocol):
+    """Subconjunto da API do cliente OpenSearch usado pelos scripts."""
+
+    indices: SearchIndices
+
+    def info(self, params: dict | None = None) -> dict: ...
+
+    def search(self, body: dict | None = None, index: str | None = None, params: dict | None = None) -> dict: ...
+
+    def msearch(self, body: Any, index: str | None = None, params: dict | None = None) -> dict: ...
+
+    def bulk(self, body: Any, index: str | None = None, params: dict | None = None) -> dict: ...
+
+    def count(self, body: dict | None = None, index: str | None = None, params: dict | None = None) -> dict: ...
+
+    def create_pit(self, index: str, params: dict | None = None, **kwargs) -> dict: ...
+
+    def delete_pit(self, body: dict | None = None, params: dict | None = None) -> dict: ...
+
+
+# =============================================================================
+# Análise de texto
+# =============================================================================
+
+def analyze(text: str) -> list[str]:
+    """lowercase + asciifolding + stopwords (aproxima o brazilian_text, sem stemmer)."""
+    folded = unicodedata.normalize("NFKD", str(text).lower())
+    folded = "".join(c for c in folded if not unicodedata.combining(c))
+    return [t for t in re.findall(r"\w+", folded) if t not in STOPWORDS]
+
+
+def fuzzy_max_edits(term: str) -> int:
+    """fuzziness AUTO: 0 edições até 2 chars, 1 até 5, 2 acima."""
+    if len(term) <= 2:
+        return 0
+    return 1 if len(term) <= 5 else 2
+
+
+def levenshtein(a: str, b: str, max_dist: int) -> int:
+    """Distância de edição com corte antecipado em max_dist + 1."""
+    if abs(len(a) - len(b)) > max_dist:
+        return max_dist + 1
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        if min(current) > max_dist:
+            return max_dist + 1
+        previous = current
+    return previous[-1]
+
+
+def parse_distance_km(distance: str | float) -> float:
+    if isinstance(distance, (int, float)):
+        return float(distance) / 1000  # número puro = metros, como no OpenSearch
+    match = re.fullmatch(r"\s*([\d.]+)\s*([a-z]*)\s*", distance)
+    if not match:
+        raise ValueError(f"Distância inválida: {distance}")
+    value, unit = match.groups()
+    return float(value) * DISTANCE_UNITS_KM[unit or "m"]
+
+
+def haversine_km(lats: np.ndarray, lons: np.ndarray, lat: float, lon: float) -> np.ndarray:
+    lat1, lon1 = np.radians(lats), np.radians(lons)
+    lat2, lon2 = math.radians(lat), math.radians(lon)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * math.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+def get_path(source: dict, path: str) -> Any:
+    value = source
+    for part in path.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+
+def filter_source(source: dict, spec: Any) -> dict | None:
+    """Aplica _source (bool, lista ou {includes, excludes}) com caminhos pontuados."""
+    if spec is None or spec is True:
+        return source
+    if spec is False:
+        return None
+    if isinstance(spec, (str, list)):
+        spec = {"includes": [spec] if isinstance(spec, str) else spec}
+    includes, excludes = spec.get("includes") or [], spec.get("excludes") or []
+
+    def walk(node: dict, prefix: str) -> dict:
+        result = {}
+        for key, value in node.items():
+            path = f"{prefix}{key}"
+            if path in excludes:
+                continue
+            if includes and not any(path == p or p.startswith(path + ".") or path.startswith(p + ".") for p in includes):
+                continue
+            result[key] = walk(value, path + ".") if isinstance(value, dict) else value
+        return result
+
+    return walk(source, "")
+
+
+# =============================================================================
+# Índice
+# =============================================================================
+
+class _Index:
+    """
+    Documentos de um índice. Escritas ficam sob lock; leituras usam `view()`.
+
+    Export fatiado e buscas hedgeadas consultam o backend de várias threads
+    enquanto um bulk pode estar escrevendo: cada query fixa uma _IndexView
+    imutável e nunca enxerga um rebuild no meio da execução.
+    """
+
+    def __init__(self, name: str, body: dict | None = None):
+        self.name = name
+        self.body = body or {}
+        self.docs: dict[str, dict] = {}
+        self.lock = threading.RLock()
+        self._view: "_IndexView | None" = None
+
+    def put(self, doc_id: str, source: dict):
+        with self.lock:
+            self.docs[doc_id] = source
+            self._view = None
+
+    def delete(self, doc_id: str) -> bool:
+        with self.lock:
+            self._view = None
+            return self.docs.pop(doc_id, None) is not None
+
+    def view(self) -> "_IndexView":
+        """Visão consistente do estado atual (reaproveitada até a próxima escrita)."""
+        with self.lock:
+            if self._view is None:
+                self._view = _IndexView(self.name, dict(self.docs))
+            return self._view
+
+
+class _IndexView:
+    """
+    Estado congelado de um índice (usado por queries e como snapshot de PIT).
+    Os caches por campo são montados sob demanda, sob o lock da própria visão.
+    """
+
+    def __init__(self, name: str, docs: dict[str, dict]):
+        self.name = name
+        self.ids = list(docs)
+        self.sources = [docs[i] for i in self.ids]
+        self.postings: dict[str, dict] = {}  # campo -> (termo -> {doc: tf}, comprimentos)
+        self.vectors: dict[str, tuple[np.ndarray, np.ndarray]] = {}
+        self.points: dict[str, tuple[np.ndarray, np.ndarray, np.ndarray]] = {}
+        self._lock = threading.Lock()
+
+    def size(self) -> int:
+        return len(self.ids)
+
+    def text_field(self, field: str) -> dict:
+        with self._lock:
+            if field not in self.postings:
+                terms: dict[str, dict[int, int]] = {}
+                lengths = np.zeros(len(self.ids), dtype=np.float32)
+                for doc_idx, source in enumerate(self.sources):
+                    value = get_path(source, field)
+                    if value is None:
+                        continue
+                    tokens = analyze(" ".join(value) if isinstance(value, list) else value)
+                    lengths[doc_idx] = len(tokens)
+                    for token in tokens:
+                        postings = terms.setdefault(token, {})
+                        postings[doc_idx] = postings.get(doc_idx, 0) + 1
+                has_field = lengths > 0
+                avg_length = float(lengths[has_field].mean()) if has_field.any() else 0.0
+                self.postings[field] = {"terms": terms, "lengths": lengths, "doc_count": int(has_field.sum()), "avg_length": avg_length}
+            return self.postings[field]
+
+    def vector_field(self, field: str) -> tuple[np.ndarray, np.ndarray]:
+        """Matriz normalizada (L2) dos vetores e índices dos docs que os possuem."""
+        with self._lock:
+            if field not in self.vectors:
+                rows = [(i, get_path(s, field)) for i, s in enumerate(self.sources) if get_path(s, field) is not None]
+                if rows:
+                    doc_idx = np.array([i for i, _ in rows])
+                    matrix = np.asarray([v for _, v in rows], dtype=np.float32)
+                    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+                    matrix /= np.where(norms == 0, 1, norms)
+                else:
+                    doc_idx, matrix = np.zeros(0, dtype=int), np.zeros((0, 0), dtype=np.float32)
+                self.vectors[field] = (matrix, doc_idx)
+            return self.vectors[field]
+
+    def geo_field(self, field: str) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """(lats, lons, máscara de docs com o campo)."""
+        with self._lock:
+            if field not in self.points:
+                lats = np.full(len(self.ids), np.nan)
+                lons = np.full(len(self.ids), np.nan)
+                for i, source in enumerate(self.sources):
+                    point = get_path(source, field)
+                    if isinstance(point, dict):
+                        lats[i], lons[i] = point["lat"], point["lon"]
+                    elif isinstance(point, (list, tuple)):
+                        lons[i], lats[i] = point  # GeoJSON: [lon, lat]
+                self.points[field] = (lats, lons, ~np.isnan(lats))
+            return self.points[field]
+
+
+# =============================================================================
+# Execução de queries
+# =============================================================================
+
+class _QueryExecutor:
+    """Avalia o DSL sobre uma _IndexView e devolve (máscara de match, scores)."""
+
+    def __init__(self, index: _IndexView):
+        self.index = index
+        self.n = index.size()
+
+    def run(self, query: dict | None) -> tuple[np.ndarray, np.ndarray]:
+        if not query:
+            return self._match_all()
+        (kind, spec), = query.items()
+        handler = getattr(self, f"_q_{kind}", None)
+        if handler is None:
+            raise NotImplementedError(f"Query '{kind}' não suportada pelo InMemoryBackend")
+        return handler(spec)
+
+    def _match_all(self, spec: dict | None = None):
+        return np.ones(self.n, dtype=bool), np.ones(self.n, dtype=np.float32)
+
+    _q_match_all = _match_all
+
+    def _q_bool(self, spec: dict):
+        def as_list(clauses):
+            return clauses if isinstance(clauses, list) else ([clauses] if clauses else [])
+
+        must, should = as_list(spec.get("must")), as_list(spec.get("should"))
+        filters, must_not = as_list(spec.get("filter")), as_list(spec.get("must_not"))
+
+        mask = np.ones(self.n, dtype=bool)
+        scores = np.zeros(self.n, dtype=np.float32)
+        for clause in must:
+            clause_mask, clause_scores = self.run(clause)
+            mask &= clause_mask
+            scores += np.where(clause_mask, clause_scores, 0)
+        for clause in filters:
+            mask &= self.run(clause)[0]
+        for clause in must_not:
+            mask &= ~self.run(clause)[0]
+
+        should_matches = np.zeros(self.n, dtype=np.int32)
+        for clause in should:
+            clause_mask, clause_scores = self.run(clause)
+            should_matches += clause_mask
+            scores += np.where(clause_mask, clause_scores, 0)
+
+        default_min = 0 if (must or filters) else 1
+        minimum = int(spec.get("minimum_should_match", default_min if should else 0))
+        mask &= should_matches >= minimum
+
+        # Só filtros: score constante, como no OpenSearch
+        if not must and not should:
+            scores = np.where(mask, 0.0 if filters else 1.0, 0).astype(np.float32)
+        return mask, scores
+
+    def _bm25_term(self, field_index: dict, term: str) -> np.ndarray:
+        scores = np.zeros(self.n, dtype=np.float32)
+        postings = field_index["terms"].get(term)
+        if not postings:
+            return scores
+        doc_count = field_index["doc_count"]
+        idf = math.log(1 + (doc_count - len(postings) + 0.5) / (len(postings) + 0.5))
+        doc_idx = np.fromiter(postings.keys(), dtype=np.int64, count=len(postings))
+        tf = np.fromiter(postings.values(), dtype=np.float32, count=len(postings))
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * field_index["lengths"][doc_idx] / field_index["avg_length"])
+        scores[doc_idx] = idf * tf * (BM25_K1 + 1) / (tf + norm)
+        return scores
+
+    def _match_field(self, field: str, query: str, fuzziness: Any = None, operator: str = "or") -> tuple[np.ndarray, np.ndarray]:
+        field_index = self.index.text_field(field)
+        mask = np.zeros(self.n, dtype=bool) if operator == "or" else np.ones(self.n, dtype=bool)
+        scores = np.zeros(self.n, dtype=np.float32)
+        for term in analyze(query):
+            variants = [term]
+            if fuzziness is not None:
+                max_edits = fuzzy_max_edits(term) if str(fuzziness).upper() == "AUTO" else int(fuzziness)
+                if max_edits:
+                    variants += [t for t in field_index["terms"] if t != term and levenshtein(term, t, max_edits) <= max_edits]
+            term_scores = np.max([self._bm25_term(field_index, v) for v in variants], axis=0)
+            term_mask = term_scores > 0
+            mask = (mask | term_mask) if operator == "or" else (mask & term_mask)
+            scores += term_scores
+        return mask, scores
+
+    def _q_match(self, spec: dict):
+        (field, options), = spec.items()
+        if not isinstance(options, dict):
+            options = {"query": options}
+        mask, scores = self._match_field(field, options["query"], options.get("fuzziness"), options.get("operator", "or").lower())
+        return mask, scores * options.get("boost", 1.0)
+
+    def _q_multi_match(self, spec: dict):
+        if spec.get("type", "best_fields") != "best_fields":
+            raise NotImplementedError("multi_match: apenas type=best_fields é suportado")
+        mask = np.zeros(self.n, dtype=bool)
+        scores = np.zeros(self.n, dtype=np.float32)
+        for field_spec in spec["fields"]:
+            field, _, boost = field_spec.partition("^")
+            field_mask, field_scores = self._match_field(field, spec["query"], spec.get("fuzziness"), spec.get("operator", "or").lower())
+            mask |= field_mask
+            scores = np.maximum(scores, field_scores * float(boost or 1))
+        return mask, scores * spec.get("boost", 1.0)
+
+    def _field_values(self, field: str) -> list:
+        return [get_path(s, field) for s in self.index.sources]
+
+    def _q_term(self, spec: dict):
+        (field, value), = spec.items()
+        if isinstance(value, dict):
+            value = value["value"]
+        return self._q_terms({field: [value]})
+
+    def _q_terms(self, spec: dict):
+        (field, values), = spec.items()
+        wanted = set(values)
+        mask = np.array([v in wanted if not isinstance(v, list) else bool(wanted & set(v)) for v in self._field_values(field)], dtype=bool)
+        return mask, mask.astype(np.float32)
+
+    def _q_range(self, spec: dict):
+        (field, bounds), = spec.items()
+        ops = {"gt": lambda v, b: v > b, "gte": lambda v, b: v >= b, "lt": lambda v, b: v < b, "lte": lambda v, b: v <= b}
+        mask = np.array([v is not None and all(ops[op](v, b) for op, b in bounds.items() if op in ops) for v in self._field_values(field)], dtype=bool)
+        return mask, mask.astype(np.float32)
+
+    def _q_exists(self, spec: dict):
+        mask = np.array([v is not None for v in self._field_values(spec["field"])], dtype=bool)
+        return mask, mask.astype(np.float32)
+
+    def _q_ids(self, spec: dict):
+        wanted = set(spec["values"])
+        mask = np.array([doc_id in wanted for doc_id in self.index.ids], dtype=bool)
+        return mask, mask.astype(np.float32)
+
+    def _q_geo_distance(self, spec: dict):
+        options = {k: v for k, v in spec.items() if k in ("distance", "distance_type", "validation_method", "_name")}
+        (field, origin), = ((k, v) for k, v in spec.items() if k not in options)
+        lat, lon = (origin["lat"], origin["lon"]) if isinstance(origin, dict) else (origin[1], origin[0])
+        lats, lons, has_point = self.index.geo_field(field)
+        distances = haversine_km(lats, lons, lat, lon)
+        mask = has_point & (distances <= parse_distance_km(options["distance"]))
+        return mask, mask.astype(np.float32)
+
+    def _q_knn(self, spec: dict):
+        """k-NN exato (força bruta); score cosinesimil = 1 / (2 - cos), como no plugin k-NN."""
+        (field, options), = spec.items()
+        matrix, doc_idx = self.index.vector_field(field)
+        mask = np.zeros(self.n, dtype=bool)
+        scores = np.zeros(self.n, dtype=np.float32)
+        if not len(doc_idx):
+            return mask, scores
+        query = np.asarray(options["vector"], dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1)
+        similarity = matrix @ query
+        k = min(options["k"], len(doc_idx))
+        top = np.argpartition(-similarity, k - 1)[:k]
+        mask[doc_idx[top]] = True
+        scores[doc_idx[top]] = 1 / (2 - similarity[top])
+        return mask, scores * options.get("boost", 1.0)
+
+
+# =============================================================================
+# Backend
+# =============================================================================
+
+class _Indices:
+    """Namespace `client.indices` com o mínimo usado pelos scripts."""
+
+    def __init__(self, backend: "InMemoryBackend"):
+        self._backend = backend
+
+    def exists(self, index: str, params: dict | None = None) -> bool:
+        return index in self._backend._indices
+
+    def create(self, index: str, body: dict | None = None, params: dict | None = None) -> dict:
+        self._backend._indices[index] = _Index(index, body)
+        return {"acknowledged": True, "index": index}
+
+    def delete(self, index: str, params: dict | None = None) -> dict:
+        self._backend._get_index(index)
+        del self._backend._indices[index]
+        return {"acknowledged": True}
+
+    def refresh(self, index: str | None = None, params: dict | None = None) -> dict:
+        # O índice em memória já reflete cada bulk
+        return {"_shards": {"total": 1, "successful": 1, "failed": 0}}
+
+
+class InMemoryBackend:
+    """
+    Backend de busca em memória compatível com o cliente OpenSearch.
+
+    Pode ser passado no lugar do `OpenSearch` para os scripts e para
+    `opensearchpy.helpers.bulk`. Índices são criados automaticamente no
+    primeiro bulk, como com `action.auto_create_index`.
+    """
+
+    def __init__(self):
+        self._indices: dict[str, _Index] = {}
+        self._pits: dict[str, _IndexView] = {}
+        self.indices = _Indices(self)
+        self.transport = SimpleNamespace(serializer=JSONSerializer())  # Usado por helpers.bulk
+
+    def _get_index(self, name: str) -> _Index:
+        if name not in self._indices:
+            raise KeyError(f"index_not_found_exception: {name}")
+        return self._indices[name]
+
+    def info(self, params: dict | None = None) -> dict:
+        return {"cluster_name": "in-memory", "version": {"number": "in-memory", "distribution": "in-memory"}}
+
+    # -------------------------------------------------------------------------
+    # Escrita
+    # -------------------------------------------------------------------------
+
+    def bulk(self, body: Any, index: str | None = None, params: dict | None = None) -> dict:
+        start = time.perf_counter()
+        if isinstance(body, (str, bytes)):
+            lines = [json.loads(line) for line in (body.decode("utf-8") if isinstance(body, bytes) else body).splitlines() if line.strip()]
+        else:
+            lines = [json.loads(line) if isinstance(line, (str, bytes)) else line for line in body]
+
+        items, errors, i = [], False, 0
+        while i < len(lines):
+            (op, meta), = lines[i].items()
+            i += 1
+            target = self._indices.setdefault(meta.get("_index", index), _Index(meta.get("_index", index)))
+            doc_id = str(meta.get("_id") or uuid.uuid4().hex)
+            item = {"_index": target.name, "_id": doc_id}
+
+            with target.lock:
+                self._apply_bulk_op(target, op, doc_id, lines[i] if op != "delete" else None, item)
+            if op != "delete":
+                i += 1
+
+            errors = errors or "error" in item
+            items.append({op: item})
+        return {"took": int((time.perf_counter() - start) * 1000), "errors": errors, "items": items}
+
+    @staticmethod
+    def _apply_bulk_op(target: _Index, op: str, doc_id: str, source: dict | None, item: dict):
+        """Aplica uma operação do bulk (chamado com target.lock adquirido)."""
+        if op == "delete":
+            found = target.delete(doc_id)
+            item.update(status=200 if found else 404, result="deleted" if found else "not_found")
+            return
+        exists = doc_id in target.docs
+        if op == "create" and exists:
+            item.update(status=409, error={"type": "version_conflict_engine_exception", "reason": f"[{doc_id}]: document already exists"})
+        elif op == "update":
+            if not exists:
+                item.update(status=404, error={"type": "document_missing_exception", "reason": f"[{doc_id}]: document missing"})
+            else:
+                target.put(doc_id, {**target.docs[doc_id], **source.get("doc", {})})
+                item.update(status=200, result="updated")
+        else:
+            target.put(doc_id, source)
+            item.update(status=200 if exists else 201, result="updated" if exists else "created")
+
+    # -------------------------------------------------------------------------
+    # Leitura
+    # -------------------------------------------------------------------------
+
+    def count(self, body: dict | None = None, index: str | None = None, params: dict | None = None) -> dict:
+        target = self._get_index(index).view()
+        mask, _ = _QueryExecutor(target).run((body or {}).get("query"))
+        return {"count": int(mask.sum()), "_shards": {"total": 1, "successful": 1, "skipped": 0, "failed": 0}}
+
+    def msearch(self, body: Any, index: str | None = None, params: dict | None = None) -> dict:
+        if isinstance(body, str):
+            body = [json.loads(line) for line in body.splitlines() if line.strip()]
+        start = time.perf_counter()
+        responses = []
+        for header, search_body in zip(body[::2], body[1::2]):
+            try:
+                responses.append({**self.search(body=search_body, index=header.get("index", index)), "status": 200})
+            except (KeyError, NotImplementedError, ValueError) as e:
+                responses.append({"error": {"type": type(e).__name__, "reason": str(e)}, "status": 400})
+        return {"took": int((time.perf_counter() - start) * 1000), "responses": responses}
+
+    def create_pit(self, index: str, params: dict | None = None, **kwargs) -> dict:
+        pit_id = uuid.uuid4().hex
+        self._pits[pit_id] = self._get_index(index).view()
+        return {"pit_id": pit_id, "_shards": {"total": 1, "successful": 1, "skipped": 0, "failed": 0}, "creation_time": int(time.time() * 1000)}
+
+    def delete_pit(self, body: dict | None = None, params: dict | None = None) -> dict:
+        pits = [{"pit_id": pit_id, "successful": self._pits.pop(pit_id, None) is not None} for pit_id in body["pit_id"]]
+        return {"pits": pits}
+
+    def search(self, body: dict | None = None, index: str | None = None, params: dict | None = None) -> dict:
+        start = time.perf_counter()
+        body = body or {}
+        target = self._pits[body["pit"]["id"]] if "pit" in body else self._get_index(index).view()
+        mask, scores = _QueryExecutor(target).run(body.get("query"))
+
+        candidates = np.flatnonzero(mask)
+        if "slice" in body:
+            slice_id, slice_max = body["slice"]["id"], body["slice"]["max"]
+            candidates = np.array([i for i in candidates if zlib.crc32(target.ids[i].encode("utf-8")) % slice_max == slice_id], dtype=np.int64)
+
+        sort_spec = body.get("sort")
+        sort_values = self._sort_values(target, sort_spec, candidates, scores) if sort_spec else None
+        if sort_values is None:
+            order = candidates[np.lexsort((candidates, -scores[candidates]))]
+            rows = [(i, None) for i in order]
+        else:
+            rows = sorted(zip(candidates, sort_values), key=lambda r: self._sort_key(r[1], sort_spec))
+            if "search_after" in body:
+                after = self._sort_key(body["search_after"], sort_spec)
+                rows = [r for r in rows if self._sort_key(r[1], sort_spec) > after]
+
+        from_, size = body.get("from", 0), body.get("size", 10)
+        track_scores = sort_values is None or any(self._sort_field(s) == "_score" for s in sort_spec)
+        hits = []
+        for doc_idx, values in rows[from_:from_ + size]:
+            hit = {"_index": target.name, "_id": target.ids[doc_idx], "_score": float(scores[doc_idx]) if track_scores else None}
+            source = filter_source(target.sources[doc_idx], body.get("_source"))
+            if source is not None:
+                hit["_source"] = json.loads(json.dumps(source))  # cópia: os scripts anotam o _source
+            if values is not None:
+                hit["sort"] = values
+            hits.append(hit)
+
+        hits_section = {"max_score": float(scores[candidates].max()) if len(candidates) and track_scores else None, "hits": hits}
+        if body.get("track_total_hits", True) is not False:
+            hits_section = {"total": {"value": len(candidates), "relation": "eq"}, **hits_section}
+        response = {"took": int((time.perf_counter() - start) * 1000), "timed_out": False, "_shards": {"total": 1, "successful": 1, "skipped": 0, "failed": 0}, "hits": hits_section}
+        if "pit" in body:
+            response["pit_id"] = body["pit"]["id"]
+        return response
+
+    @staticmethod
+    def _sort_field(spec: Any) -> str:
+        return spec if isinstance(spec, str) else next(iter(spec))
+
+    @staticmethod
+    def _sort_order(spec: Any) -> str:
+        if isinstance(spec, str):
+            return "desc" if spec == "_score" else "asc"
+        options = next(iter(spec.values()))
+        if isinstance(options, str):
+            return options
+        return options.get("order", "desc" if InMemoryBackend._sort_field(spec) == "_score" else "asc")
+
+    def _sort_values(self, target: _IndexView, sort_spec: list, candidates: np.ndarray, scores: np.ndarray) -> list[list]:
+        columns = []
+        for spec in sort_spec:
+            field = self._sort_field(spec)
+            if field == "_score":
+                columns.append([float(s) for s in scores[candidates]])
+            elif field == "_geo_distance":
+                options = spec[field]
+                (geo_field, origin), = ((k, v) for k, v in options.items() if k not in ("order", "unit", "distance_type", "mode", "ignore_unmapped"))
+                lat, lon = (origin["lat"], origin["lon"]) if isinstance(origin, dict) else (origin[1], origin[0])
+                lats, lons, _ = target.geo_field(geo_field)
+                distances = haversine_km(lats[candidates], lons[candidates], lat, lon) / DISTANCE_UNITS_KM[options.get("unit", "m")]
+                columns.append([float(d) if not math.isnan(d) else math.inf for d in distances])
+            else:
+                columns.append([get_path(target.sources[i], field) for i in candidates])
+        return [list(row) for row in zip(*columns)]
+
+    def _sort_key(self, values: list, sort_spec: list) -> tuple:
+        key = []
+        for value, spec in zip(values, sort_spec):
+            descending = self._sort_order(spec) == "desc"
+            # Valores ausentes vão para o fim, nos dois sentidos
+            if value is None:
+                key.append((1, 0))
+            elif isinstance(value, (int, float)):
+                key.append((0, -value if descending else value))
+            else:
+                key.append((0, _Reversed(value) if descending else value))
+        return tuple(key)
+
+
+class _Reversed:
+    """Inverte a comparação de valores não numéricos (sort desc em strings)."""
+
+    def __init__(self, value: Any):
+        self.value = value
+
+    def __lt__(self, other: "_Reversed") -> bool:
+        return other.value < self.value
+
+    def __gt__(self, other: "_Reversed") -> bool:
+        return other.value > self.value
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, _Reversed) and other.value == self.value
+
+
+_shared_backend: InMemoryBackend | None = None
+
+
+def get_shared_memory_backend() -> InMemoryBackend:
+    """Instância única por processo, para que ingestão e queries vejam os mesmos dados."""
+    global _shared_backend
+    if _shared_backend is None:
+        _shared_backend = InMemoryBackend()
+    return _shared_backend
@@ -0,0 +1,67 @@
+import importlib.util
+import sys
+from pathlib import Path
+
+import pytest
+
+CODE_DIR = Path(__file__).parent.parent / "code"
+sys.path.insert(0, str(CODE_DIR))
+
+import search_backend  # noqa: E402
+
+
+def load_script(filename: str):
+    """Importa um script numerado (ex.: 04_hybrid_queries.py) como módulo."""
+    spec = importlib.util.spec_from_file_location(filename.removesuffix(".py"), CODE_DIR / filename)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def offline_env(monkeypatch):
+    """Backend em memória + embeddings fake, com uma instância compartilhada nova por teste."""
+    monkeypatch.setenv("SEARCH_BACKEND", "memory")
+    monkeypatch.setenv("EMBEDDINGS_BACKEND", "fake")
+    monkeypatch.setenv("INGEST_MODE", "legacy")
+    monkeypatch.setattr(search_backend, "_shared_backend", None)
+    return search_backend.get_shared_memory_backend()
+
+
+SP = (-23.5505, -46.6333)
+RJ = (-22.9068, -43.1729)
+
+
+def make_doc(doc_id: str, nome: str, cnae: str, atividade: str, cidade: str, uf: str, lat: float, lon: float, situacao: str = "ATIVA") -> dict:
+    return {
+        "_id": doc_id,
+        "cnpj": doc_id,
+        "razao_social": nome,
+        "nome_fantasia": nome.split()[0],
+        "cnae_descricao": cnae,
+        "descricao_atividade": atividade,
+        "localizacao": {"lat": lat, "lon": lon},
+        "endereco": {"cidade": cidade, "uf": uf},
+        "situacao_cadastral": situacao,
+    }
+
+
+DOCUMENTS = [
+    make_doc("001", "PEDREIRA ALFA LTDA", "Extração de granito e beneficiamento associado", "Granito e mármore para obras", "São Paulo", "SP", -23.55, -46.63),
+    make_doc("002", "AREAL BETA ME", "Extração de areia, cascalho ou pedregulho", "Areia e cascalho para construção", "São Paulo", "SP", -23.60, -46.70),
+    make_doc("003", "DEPOSITO GAMA EPP", "Comércio varejista de materiais de construção", "Materiais de construção em geral", "São Paulo", "SP", -23.45, -46.55),
+    make_doc("004", "CONSTRUCAO DELTA EIRELI", "Comércio varejista de materiais de construção", "Materiais de construção e ferragens", "Campinas", "SP", -22.91, -47.06, situacao="BAIXADA"),
+    make_doc("005", "AREIA RIO LTDA", "Extração de areia, cascalho ou pedregulho", "Areia e cascalho para construção", "Rio de Janeiro", "RJ", -22.90, -43.17),
+    make_doc("006", "MARMORES EPSILON SA", "Comércio atacadista de mármores e granitos", "Mármore e granito importados", "Rio de Janeiro", "RJ", -22.95, -43.20),
+]
+
+
+@pytest.fixture
+def pipeline(offline_env):
+    """Ingestão via 03 + clientes do 04 apontando para o mesmo backend em memória."""
+    ingest = load_script("03_index_with_embeddings.py")
+    queries = load_script("04_hybrid_queries.py")
+    success, failed = ingest.index_documents([dict(d) for d in DOCUMENTS])
+    assert (success, failed) == (len(DOCUMENTS), 0)
+    queries.init_clients()
+    return queries
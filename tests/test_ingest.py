@@ -0,0 +1,132 @@
+"""Modo de ingestão (03): serialização, arredondamento, chunks por bytes e falhas de embedding."""
+
+import json
+from datetime import datetime, timezone
+
+import pytest
+from opensearchpy.exceptions import SerializationError
+from opensearchpy.serializer import JSONSerializer
+
+from conftest import load_script
+from embeddings import FakeEmbeddingsClient
+
+
+@pytest.fixture
+def ingest(offline_env):
+    return load_script("03_index_with_embeddings.py")
+
+
+@pytest.fixture
+def compact_ingest(offline_env, monkeypatch):
+    monkeypatch.setenv("INGEST_MODE", "compact")
+    monkeypatch.setenv("INGEST_BULK_MAX_BYTES", "40000")
+    return load_script("03_index_with_embeddings.py")
+
+
+def make_documents(n: int) -> list[dict]:
+    return [
+        {"_id": f"{i:03d}", "cnpj": f"{i:03d}", "razao_social": f"EMPRESA {i} LTDA", "cnae_descricao": "Comércio de materiais de construção", "localizacao": {"lat": -23.5, "lon": -46.6}, "endereco": {"cidade": "São Paulo", "uf": "SP"}}
+        for i in range(n)
+    ]
+
+
+class FailingEmbeddingsClient(FakeEmbeddingsClient):
+    """Falha a partir da chamada `fail_on` (1-based), como um 429 do Azure."""
+
+    def __init__(self, fail_on: int):
+        super().__init__()
+        self.calls = 0
+        self.fail_on = fail_on
+
+    def _create(self, input, model=None):
+        self.calls += 1
+        if self.calls >= self.fail_on:
+            raise RuntimeError("429 Too Many Requests")
+        return super()._create(input, model)
+
+
+def test_round_vector(ingest):
+    assert ingest.round_vector([0.0123456789, -0.98765432], 4) == [0.0123, -0.9877]
+    vector = [0.0123456789]
+    assert ingest.round_vector(vector, -1) is vector
+
+
+@pytest.mark.parametrize("data", [
+    {"cidade": "São Paulo", "n": 1, "x": 0.1, "ok": True, "nada": None, "lista": [1, "ação"]},
+    {"indexed_at": datetime(2024, 1, 2, 3, 4, 5, tzinfo=timezone.utc)},
+])
+def test_fast_serializer_matches_json_serializer(ingest, data):
+    fast, std = ingest.FastJSONSerializer(), JSONSerializer()
+    assert json.loads(fast.dumps(data)) == json.loads(std.dumps(data))
+    assert fast.loads(fast.dumps(data)) == std.loads(std.dumps(data))
+    if "cidade" in data:
+        assert "São Paulo" in fast.dumps(data)
+
+
+def test_fast_serializer_passes_strings_through(ingest):
+    assert ingest.FastJSONSerializer().dumps('{"a":1}') == '{"a":1}'
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_fast_serializer_raises_serialization_error(ingest, monkeypatch, use_orjson):
+    if not use_orjson:
+        monkeypatch.setattr(ingest, "orjson", None)
+    serializer = ingest.FastJSONSerializer()
+    with pytest.raises(SerializationError):
+        serializer.dumps({"x": object()})
+    with pytest.raises(SerializationError):
+        serializer.loads("{não é json")
+
+
+def test_is_compact_mode(ingest, monkeypatch):
+    assert ingest.is_compact_mode() is False
+    monkeypatch.setattr(ingest, "INGEST_MODE", "compact")
+    assert ingest.is_compact_mode() is True
+    monkeypatch.setattr(ingest, "INGEST_MODE", "compacto")
+    with pytest.raises(ValueError, match="INGEST_MODE"):
+        ingest.is_compact_mode()
+
+
+def test_measure_payload(ingest):
+    actions = [{"_index": "i", "_id": str(i), "_source": {"embedding": [0.123456789] * 10}} for i in range(4)]
+    serializer = JSONSerializer()
+    body = ingest.encode_bulk_body(actions, serializer)
+
+    bytes_per_doc, encode_ms = ingest.measure_payload(actions, serializer)
+    gzip_bytes_per_doc, _ = ingest.measure_payload(actions, serializer, compress=True)
+
+    assert body.count(b"\n") == 2 * len(actions)
+    assert bytes_per_doc == len(body) / len(actions)
+    assert encode_ms >= 0
+    assert gzip_bytes_per_doc < bytes_per_doc
+
+
+def test_compact_ingest_chunks_by_bytes(compact_ingest, offline_env, monkeypatch):
+    calls = []
+    original_bulk = offline_env.bulk
+
+    def counting_bulk(body, *args, **kwargs):
+        calls.append(len(body.encode("utf-8")) if isinstance(body, str) else len(body))
+        return original_bulk(body, *args, **kwargs)
+
+    monkeypatch.setattr(offline_env, "bulk", counting_bulk)
+    documents = make_documents(30)
+
+    assert compact_ingest.index_documents(documents) == (30, 0)
+    assert len(calls) > 1
+    assert all(size <= compact_ingest.BULK_MAX_BYTES for size in calls)
+
+    source = offline_env.search(index=compact_ingest.INDEX_NAME, body={"query": {"ids": {"values": ["000"]}}})["hits"]["hits"][0]["_source"]
+    assert all(round(x, compact_ingest.VECTOR_DECIMALS) == x for x in source["embedding"])
+
+
+@pytest.mark.parametrize("fixture_name", ["ingest", "compact_ingest"])
+def test_embedding_failure_keeps_already_embedded_batches(request, offline_env, monkeypatch, fixture_name):
+    module = request.getfixturevalue(fixture_name)
+    monkeypatch.setattr(module, "get_azure_client", lambda: FailingEmbeddingsClient(fail_on=3))
+
+    with pytest.raises(RuntimeError, match="429"):
+        module.index_documents(make_documents(3 * module.BATCH_SIZE))
+
+    # Os 2 batches embedados antes da falha foram indexados
+    assert offline_env.count(index=module.INDEX_NAME)["count"] == 2 * module.BATCH_SIZE
@@ -0,0 +1,168 @@
+"""Orçamento de latência do query_hybrid (04): degradação, circuit breaker e hedge."""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from conftest import SP
+from embeddings import FakeEmbeddingsClient
+
+QUERY = "areia cascalho construção"
+
+
+class SlowEmbeddingsClient(FakeEmbeddingsClient):
+    """Embeddings com atraso fixo e/ou falha, contando as chamadas."""
+
+    def __init__(self, delay_s: float = 0.0, fail: bool = False):
+        super().__init__()
+        self.delay_s = delay_s
+        self.fail = fail
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _create(self, input, model=None):
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.delay_s)
+        if self.fail:
+            raise ConnectionError("Azure indisponível")
+        return super()._create(input, model)
+
+
+def hybrid(pipeline, budget_ms: float = 100):
+    return pipeline.query_hybrid(QUERY, *SP, distance="50km", size=5, latency_budget_ms=budget_ms)
+
+
+# =============================================================================
+# Circuit breaker
+# =============================================================================
+
+def test_circuit_breaker_state_machine(pipeline):
+    breaker = pipeline.CircuitBreaker(failure_threshold=2, reset_seconds=0.05)
+    assert breaker.allow()
+
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert not breaker.allow()
+
+    time.sleep(0.06)
+    assert breaker.allow()       # half-open: uma tentativa
+    assert not breaker.allow()   # as demais continuam bloqueadas
+
+    breaker.record_failure()     # tentativa falhou: reabre
+    assert not breaker.allow()
+
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record_success()     # tentativa ok: fecha
+    assert breaker.failures == 0
+    assert breaker.allow() and breaker.allow()
+
+
+# =============================================================================
+# Degradação
+# =============================================================================
+
+def test_slow_embedding_degrades_to_bm25_geo(pipeline):
+    pipeline.azure_client = SlowEmbeddingsClient(delay_s=0.5)
+
+    start = time.perf_counter()
+    results = hybrid(pipeline, budget_ms=50)
+
+    assert time.perf_counter() - start < 0.4
+    assert results["degraded"] is True
+    assert results["degraded_reason"] == "embedding_timeout"
+    assert [hit["_id"] for hit in results["hits"]["hits"]][0] == "002"
+
+
+def test_failing_embedding_opens_breaker_and_short_circuits(pipeline, monkeypatch):
+    client = SlowEmbeddingsClient(fail=True)
+    pipeline.azure_client = client
+    monkeypatch.setattr(pipeline, "embedding_breaker", pipeline.CircuitBreaker(failure_threshold=3, reset_seconds=0.1))
+
+    reasons = [hybrid(pipeline)["degraded_reason"] for _ in range(5)]
+
+    assert reasons == ["embedding_error"] * 3 + ["circuit_open"] * 2
+    assert client.calls == 3
+
+    # Half-open com o endpoint recuperado: uma tentativa e o circuito fecha
+    time.sleep(0.12)
+    client.fail = False
+    results = hybrid(pipeline)
+    assert results["degraded"] is False
+    assert client.calls == 4
+    assert pipeline.embedding_breaker.failures == 0
+    assert hybrid(pipeline)["degraded"] is False
+
+
+def test_burst_on_healthy_endpoint_does_not_open_breaker(pipeline):
+    pipeline.azure_client = SlowEmbeddingsClient(delay_s=0.15)
+
+    with ThreadPoolExecutor(max_workers=12) as executor:
+        results = list(executor.map(lambda _: hybrid(pipeline, budget_ms=300), range(12)))
+
+    assert [r["degraded_reason"] for r in results] == [None] * 12
+    assert pipeline.embedding_breaker.failures == 0
+
+
+def test_saturated_pool_degrades_without_tripping_breaker(pipeline, monkeypatch):
+    pipeline.azure_client = SlowEmbeddingsClient(delay_s=0.15)
+    monkeypatch.setattr(pipeline, "_embedding_slots", threading.BoundedSemaphore(2))
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(lambda _: hybrid(pipeline, budget_ms=300), range(8)))
+
+    reasons = [r["degraded_reason"] for r in results]
+    assert reasons.count(None) >= 2
+    assert set(reasons) <= {None, "embedding_saturated"}
+    assert "embedding_saturated" in reasons
+    assert pipeline.embedding_breaker.failures == 0
+    assert pipeline.embedding_breaker.allow()
+
+
+# =============================================================================
+# Hedge
+# =============================================================================
+
+@pytest.fixture
+def slow_primary(pipeline, monkeypatch):
+    """Busca primária (sem preference) lenta; o hedge responde rápido."""
+    original_search = pipeline.os_client.search
+    calls = []
+
+    def search(index=None, body=None, params=None):
+        calls.append((params or {}).get("preference"))
+        if not (params or {}).get("preference"):
+            time.sleep(0.5)
+        return original_search(index=index, body=body, params=params)
+
+    monkeypatch.setattr(pipeline.os_client, "search", search)
+    return calls
+
+
+def test_fast_search_is_not_hedged(pipeline):
+    results = hybrid(pipeline)
+    assert results["hedged"] is False
+
+
+def test_slow_primary_is_hedged_and_hedge_wins(pipeline, slow_primary):
+    start = time.perf_counter()
+    results = hybrid(pipeline)
+
+    assert time.perf_counter() - start < 0.4
+    assert results["hedged"] is True
+    assert results["hits"]["hits"]
+    assert slow_primary[0] is None and slow_primary[1].startswith("hedge-")
+
+
+def test_hedged_search_times_out(pipeline, monkeypatch):
+    monkeypatch.setattr(pipeline.os_client, "search", lambda index=None, body=None, params=None: time.sleep(1))
+    monkeypatch.setattr(pipeline, "SEARCH_MAX_WAIT_MS", 200)
+
+    start = time.perf_counter()
+    with pytest.raises(TimeoutError):
+        pipeline.search_hedged({"query": {"match_all": {}}})
+    assert time.perf_counter() - start < 0.5
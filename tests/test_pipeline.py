@@ -0,0 +1,83 @@
+"""Pipeline ponta a ponta offline: ingestão (03) -> queries/export (04)."""
+
+import pytest
+
+from conftest import DOCUMENTS, RJ, SP
+
+
+def test_ingest_populates_shared_backend(pipeline, offline_env):
+    assert pipeline.os_client is offline_env
+    assert offline_env.count(index=pipeline.INDEX_NAME)["count"] == len(DOCUMENTS)
+    source = offline_env.search(index=pipeline.INDEX_NAME, body={"query": {"ids": {"values": ["001"]}}})["hits"]["hits"][0]["_source"]
+    assert len(source["embedding"]) == 1536
+
+
+def test_knn_finds_document_with_same_text(pipeline):
+    results = pipeline.query_knn("Areia e cascalho para construção", k=3)
+    ids = [hit["_id"] for hit in results["hits"]["hits"]]
+    assert len(ids) == 3
+    assert set(ids[:2]) == {"002", "005"}
+
+
+def test_hybrid_fuses_knn_and_respects_geo(pipeline):
+    results = pipeline.query_hybrid("areia cascalho construção", *SP, distance="50km", size=5)
+    hits = results["hits"]["hits"]
+    assert hits, "esperava matches em SP"
+    assert all(hit["_source"]["endereco"]["uf"] == "SP" for hit in hits)
+    assert hits[0]["_id"] == "002"
+
+    bm25_only = pipeline.query_hybrid("areia cascalho construção", *SP, distance="50km", size=5, use_knn=False)
+    scores = {hit["_id"]: hit["_score"] for hit in bm25_only["hits"]["hits"]}
+    # A cláusula k-NN (should) soma score sobre o BM25
+    assert hits[0]["_score"] > scores["002"]
+
+
+def test_latency_budget_not_degraded_with_fake_embeddings(pipeline):
+    results = pipeline.query_hybrid("areia cascalho", *RJ, distance="50km", size=5, latency_budget_ms=1000)
+    assert results["degraded"] is False
+    assert [hit["_id"] for hit in results["hits"]["hits"]][0] == "005"
+
+
+def test_count_with_filters(pipeline, offline_env):
+    filters = [{"term": {"situacao_cadastral": "ATIVA"}}, {"term": {"endereco.uf": "SP"}}]
+    body = pipeline.build_fulltext_body("materiais de construção", filters=filters)
+    assert offline_env.count(index=pipeline.INDEX_NAME, body={"query": body["query"]})["count"] == 2
+
+
+@pytest.mark.parametrize("slices", [1, 3])
+def test_pit_export_matches_count(pipeline, offline_env, slices):
+    body = pipeline.build_geo_body(*SP, distance="100km")
+    expected = offline_env.count(index=pipeline.INDEX_NAME, body={"query": body["query"]})["count"]
+
+    hits = list(pipeline.export_results(body, source_includes=["cnpj", "endereco.cidade"], page_size=1, slices=slices))
+
+    assert len(hits) == expected == 4
+    assert len({hit["_id"] for hit in hits}) == expected
+    assert set(hits[0]["_source"]) == {"cnpj", "endereco"}
+    assert offline_env._pits == {}
+
+
+def test_sliced_export_stopped_early_deletes_pit(pipeline, offline_env):
+    body = pipeline.build_geo_body(*SP, distance="1000km")
+
+    for hit in pipeline.export_results(body, page_size=1, slices=3):
+        break
+
+    assert hit["_id"]
+    assert offline_env._pits == {}
+
+
+def test_sliced_export_propagates_worker_error_and_deletes_pit(pipeline, offline_env, monkeypatch):
+    original_search = offline_env.search
+
+    def failing_search(body=None, index=None, params=None):
+        if body.get("slice", {}).get("id") == 1:
+            raise ConnectionError("shard indisponível")
+        return original_search(body=body, index=index, params=params)
+
+    monkeypatch.setattr(offline_env, "search", failing_search)
+    body = pipeline.build_geo_body(*SP, distance="1000km")
+
+    with pytest.raises(ConnectionError, match="shard indisponível"):
+        list(pipeline.export_results(body, page_size=1, slices=3))
+    assert offline_env._pits == {}
@@ -0,0 +1,161 @@
+import threading
+
+import numpy as np
+import pytest
+
+from search_backend import InMemoryBackend, analyze, haversine_km, parse_distance_km
+
+INDEX = "idx"
+
+
+@pytest.fixture
+def backend():
+    backend = InMemoryBackend()
+    docs = [
+        {"texto": "areia areia cascalho", "uf": "SP", "v": [1.0, 0.0], "geo": {"lat": -23.55, "lon": -46.63}, "n": 1},
+        {"texto": "areia para construção civil em geral", "uf": "SP", "v": [0.0, 1.0], "geo": {"lat": -22.91, "lon": -47.06}, "n": 2},
+        {"texto": "mármore e granito", "uf": "RJ", "v": [0.7, 0.7], "geo": {"lat": -22.90, "lon": -43.17}, "n": 3},
+    ]
+    body = []
+    for i, doc in enumerate(docs):
+        body += [{"index": {"_index": INDEX, "_id": str(i)}}, doc]
+    assert backend.bulk(body)["errors"] is False
+    return backend
+
+
+def ids(response: dict) -> list[str]:
+    return [hit["_id"] for hit in response["hits"]["hits"]]
+
+
+def test_analyze_folds_accents_and_drops_stopwords():
+    assert analyze("Materiais de Construção") == ["materiais", "construcao"]
+
+
+def test_distance_helpers():
+    assert parse_distance_km("50km") == 50
+    assert parse_distance_km("500m") == 0.5
+    # São Paulo -> Rio de Janeiro ~ 361 km em linha reta
+    assert haversine_km(np.array([-23.5505]), np.array([-46.6333]), -22.9068, -43.1729)[0] == pytest.approx(361, abs=2)
+
+
+def test_bm25_ranks_higher_term_frequency_and_shorter_field(backend):
+    response = backend.search(index=INDEX, body={"query": {"match": {"texto": "areia"}}})
+    assert ids(response) == ["0", "1"]
+    assert response["hits"]["total"]["value"] == 2
+
+
+def test_fuzzy_match(backend):
+    assert ids(backend.search(index=INDEX, body={"query": {"match": {"texto": {"query": "granitu", "fuzziness": "AUTO"}}}})) == ["2"]
+
+
+def test_knn_scores_and_does_not_mutate_query(backend):
+    query = np.array([3.0, 4.0], dtype=np.float32)
+    response = backend.search(index=INDEX, body={"query": {"knn": {"v": {"vector": query, "k": 2}}}})
+    assert ids(response) == ["2", "1"]
+    cos = (0.7 * 0.6 + 0.7 * 0.8) / np.hypot(0.7, 0.7)
+    assert response["hits"]["hits"][0]["_score"] == pytest.approx(1 / (2 - cos), rel=1e-5)
+    assert query.tolist() == [3.0, 4.0]
+
+
+def test_geo_distance_filter_and_sort(backend):
+    body = {
+        "query": {"bool": {"filter": {"geo_distance": {"distance": "100km", "geo": {"lat": -23.55, "lon": -46.63}}}}},
+        "sort": [{"_geo_distance": {"geo": {"lat": -23.55, "lon": -46.63}, "order": "asc", "unit": "km"}}],
+    }
+    response = backend.search(index=INDEX, body=body)
+    assert ids(response) == ["0", "1"]
+    assert response["hits"]["hits"][0]["sort"][0] == pytest.approx(0, abs=1e-6)
+    assert response["hits"]["hits"][0]["_score"] is None
+
+
+def test_search_after_pages_through_sorted_results(backend):
+    body = {"size": 1, "sort": [{"n": "desc"}]}
+    first = backend.search(index=INDEX, body=body)
+    second = backend.search(index=INDEX, body={**body, "search_after": first["hits"]["hits"][0]["sort"]})
+    assert ids(first) + ids(second) == ["2", "1"]
+
+
+def test_msearch_reports_errors_per_request(backend):
+    response = backend.msearch(body=[{"index": INDEX}, {"query": {"term": {"uf": "RJ"}}}, {"index": INDEX}, {"query": {"unknown": {}}}])
+    assert [r["status"] for r in response["responses"]] == [200, 400]
+    assert ids(response["responses"][0]) == ["2"]
+
+
+def test_bulk_create_conflict_update_and_delete(backend):
+    response = backend.bulk([
+        {"create": {"_index": INDEX, "_id": "0"}}, {"texto": "dup"},
+        {"update": {"_index": INDEX, "_id": "1"}}, {"doc": {"uf": "MG"}},
+        {"delete": {"_index": INDEX, "_id": "2"}},
+    ])
+    assert response["errors"] is True
+    assert [next(iter(item.values()))["status"] for item in response["items"]] == [409, 200, 200]
+    assert backend.count(index=INDEX, body={"query": {"term": {"uf": "MG"}}})["count"] == 1
+    assert backend.count(index=INDEX)["count"] == 2
+
+
+def test_pit_snapshot_ignores_later_writes(backend):
+    pit_id = backend.create_pit(index=INDEX, keep_alive="1m")["pit_id"]
+    backend.bulk([{"index": {"_index": INDEX, "_id": "9"}}, {"texto": "novo"}])
+    assert len(backend.search(body={"pit": {"id": pit_id}})["hits"]["hits"]) == 3
+    assert backend.delete_pit(body={"pit_id": [pit_id]})["pits"][0]["successful"] is True
+
+
+def test_concurrent_searches_on_fresh_snapshot(backend):
+    pit_id = backend.create_pit(index=INDEX)["pit_id"]
+    errors = []
+
+    def worker():
+        try:
+            backend.search(body={"pit": {"id": pit_id}, "query": {"bool": {"must": {"match": {"texto": "areia"}}, "filter": {"geo_distance": {"distance": "1000km", "geo": {"lat": 0, "lon": 0}}}}}})
+        except Exception as e:  # pragma: no cover - só em caso de corrida
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+
+
+def test_live_searches_stay_consistent_during_concurrent_bulk(backend):
+    stop = threading.Event()
+    errors = []
+    query = {
+        "query": {"bool": {
+            "must": {"match": {"texto": "areia"}},
+            "should": {"knn": {"v": {"vector": [1.0, 1.0], "k": 3}}},
+            "filter": {"geo_distance": {"distance": "1000km", "geo": {"lat": -23.0, "lon": -46.0}}},
+        }},
+        "sort": ["_score", {"_geo_distance": {"geo": {"lat": -23.0, "lon": -46.0}, "order": "asc", "unit": "km"}}],
+    }
+
+    # Índice maior: rebuilds mais lentos alargam a janela de corrida
+    seed = []
+    for i in range(500):
+        seed += [{"index": {"_index": INDEX, "_id": f"s{i}"}}, {"texto": f"areia lote {i}", "v": [1.0, float(i)], "geo": {"lat": -23.0, "lon": -46.0}}]
+    backend.bulk(seed)
+
+    def writer():
+        for i in range(300):
+            backend.bulk([{"index": {"_index": INDEX, "_id": f"w{i}"}}, {"texto": "areia nova", "v": [0.5, 0.5], "geo": {"lat": -23.0, "lon": -46.0}}])
+        stop.set()
+
+    def reader():
+        try:
+            while not stop.is_set():
+                response = backend.search(index=INDEX, body=query)
+                assert len(response["hits"]["hits"]) <= response["hits"]["total"]["value"]
+                backend.count(index=INDEX, body={"query": query["query"]})
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+
+    threads = [threading.Thread(target=reader) for _ in range(4)] + [threading.Thread(target=writer)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert backend.count(index=INDEX)["count"] == 803